@@ -1,10 +1,21 @@
 # database.py
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 engine = create_engine("sqlite:///test.db")
 
+
+# WAL lets readers keep going while a background batch holds the writer lock,
+# and busy_timeout makes writers wait briefly instead of failing immediately.
+@event.listens_for(engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+
 # Create declaritive base meta instance
 Base = declarative_base()
 # Create session local class for session maker
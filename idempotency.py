@@ -0,0 +1,295 @@
+import asyncio
+import hashlib
+import re
+import uuid
+from datetime import datetime, timedelta
+
+import anyio
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from database import SessionLocal
+from middleware import get_current_user_from_request
+from models import IdempotencyKey
+
+IDEMPOTENCY_HEADER = 'idempotency-key'
+# Write endpoints that honour the Idempotency-Key header
+IDEMPOTENT_ROUTES = [
+    re.compile(r'^/books/$'),
+    re.compile(r'^/borrow/\d+/\d+$'),
+    re.compile(r'^/reviews/$'),
+]
+# How long a stored response can be replayed
+KEY_TTL = timedelta(hours=24)
+MAX_KEY_LENGTH = 255
+# How long a duplicate waits for the in-flight original before giving up
+WAIT_TIMEOUT_SECONDS = 30
+# How long a claim stays in flight without renewal before a retry may take it over, so a
+# key is not stuck until KEY_TTL when the original worker dies before storing its response
+CLAIM_LEASE = timedelta(seconds=10)
+# How often a running original renews its lease; well under CLAIM_LEASE
+LEASE_RENEW_SECONDS = 3
+POLL_INTERVAL_SECONDS = 0.1
+PURGE_BATCH_SIZE = 500
+
+
+def fingerprint_request(method: str, path: str, body: bytes):
+    digest = hashlib.sha256()
+    for part in (method.encode(), path.encode(), body):
+        digest.update(len(part).to_bytes(8, 'big'))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def get_key_record(db: Session, user: str, key: str, now: datetime):
+    record = db.query(IdempotencyKey).filter(IdempotencyKey.user == user, IdempotencyKey.key == key).first()
+    if record is not None and record.expires_at <= now:
+        db.delete(record)
+        db.commit()
+        return None
+    return record
+
+
+def owned_claim(db: Session, user: str, key: str, token: str):
+    # Writes by an owner go through its claim token, so an owner whose claim was taken
+    # over cannot renew, overwrite or delete the new owner's claim
+    return db.query(IdempotencyKey).filter(
+        IdempotencyKey.user == user,
+        IdempotencyKey.key == key,
+        IdempotencyKey.claim_token == token,
+        IdempotencyKey.status_code.is_(None)
+    )
+
+
+def take_over_claim(db: Session, record: IdempotencyKey, now: datetime):
+    # Compare-and-set on the claim token so only one retry takes over an abandoned claim
+    token = uuid.uuid4().hex
+    taken = owned_claim(db, record.user, record.key, record.claim_token).update({
+        IdempotencyKey.claim_token: token,
+        IdempotencyKey.locked_until: now + CLAIM_LEASE,
+    }, synchronize_session=False)
+    db.commit()
+    if taken != 1:
+        return False
+    record.claim_token = token
+    return True
+
+
+def claim_key(db: Session, user: str, key: str, fingerprint: str, allow_takeover: bool = True):
+    # Returns (claimed, record); the unique (user, key) constraint picks a single winner
+    now = datetime.utcnow()
+    record = get_key_record(db, user, key, now)
+    if record is not None:
+        lease_expired = record.status_code is None and record.locked_until <= now
+        if allow_takeover and lease_expired and record.fingerprint == fingerprint and \
+                take_over_claim(db, record, now):
+            return True, record
+        return False, record
+
+    record = IdempotencyKey(key=key, user=user, fingerprint=fingerprint, claim_token=uuid.uuid4().hex,
+                            created_at=now, locked_until=now + CLAIM_LEASE, expires_at=now + KEY_TTL)
+    db.add(record)
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        return False, get_key_record(db, user, key, now)
+    return True, record
+
+
+def renew_claim(db: Session, user: str, key: str, token: str):
+    owned_claim(db, user, key, token).update(
+        {IdempotencyKey.locked_until: datetime.utcnow() + CLAIM_LEASE}, synchronize_session=False
+    )
+    db.commit()
+
+
+def store_response(db: Session, user: str, key: str, token: str, status_code: int, content_type: str,
+                   body: bytes):
+    owned_claim(db, user, key, token).update({
+        IdempotencyKey.status_code: status_code,
+        IdempotencyKey.content_type: content_type,
+        IdempotencyKey.response_body: body,
+    }, synchronize_session=False)
+    db.commit()
+
+
+def release_key(db: Session, user: str, key: str, token: str):
+    owned_claim(db, user, key, token).delete(synchronize_session=False)
+    db.commit()
+
+
+def purge_expired_keys(db: Session, now: datetime = None, batch_size: int = PURGE_BATCH_SIZE):
+    now = now or datetime.utcnow()
+    purged = 0
+    while True:
+        ids = [row.id for row in db.query(IdempotencyKey.id).filter(
+            IdempotencyKey.expires_at <= now
+        ).limit(batch_size)]
+        if not ids:
+            break
+        db.query(IdempotencyKey).filter(IdempotencyKey.id.in_(ids)).delete(synchronize_session=False)
+        db.commit()
+        purged += len(ids)
+        if len(ids) < batch_size:
+            break
+    return purged
+
+
+def run_with_session(func, *args):
+    db = SessionLocal()
+    try:
+        return func(db, *args)
+    finally:
+        db.close()
+
+
+# The first request for a key claims it and runs normally; its response is stored and
+# retries with the same key get it back without reaching the endpoint. Duplicates that
+# arrive while the original is still running wait for it to finish.
+class IdempotencyMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self._in_flight = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'POST' or \
+                not any(route.match(scope['path']) for route in IDEMPOTENT_ROUTES):
+            await self.app(scope, receive, send)
+            return
+
+        request = Request(scope, receive)
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if key is None:
+            await self.app(scope, receive, send)
+            return
+
+        if not key or len(key) > MAX_KEY_LENGTH:
+            response = JSONResponse({'detail': 'Invalid Idempotency-Key header'}, status_code=400)
+            await response(scope, receive, send)
+            return
+
+        # Without a valid token there is no user to scope the key to; let the endpoint
+        # reject the request rather than sharing stored responses between clients
+        current_user = await get_current_user_from_request(request)
+        if current_user is None:
+            await self.app(scope, receive, send)
+            return
+
+        body = await request.body()
+        user = current_user['username']
+        fingerprint = fingerprint_request(scope['method'], scope['path'], body)
+
+        deadline = asyncio.get_running_loop().time() + WAIT_TIMEOUT_SECONDS
+        while True:
+            # A claim held by this process is renewed while it runs, never taken over
+            allow_takeover = (user, key) not in self._in_flight
+            claimed, record = await run_in_threadpool(run_with_session, claim_key, user, key, fingerprint,
+                                                      allow_takeover)
+            if claimed:
+                break
+            if record is None:
+                continue  # Expired between the insert and the lookup; try again
+
+            if record.fingerprint != fingerprint:
+                response = JSONResponse(
+                    {'detail': 'Idempotency-Key was already used for a different request'}, status_code=422
+                )
+            elif record.status_code is not None:
+                response = Response(record.response_body, status_code=record.status_code,
+                                    media_type=record.content_type, headers={'Idempotent-Replayed': 'true'})
+            else:
+                remaining = deadline - asyncio.get_running_loop().time()
+                if remaining > 0:
+                    await self._wait_for_original(user, key, remaining)
+                    continue
+                response = JSONResponse(
+                    {'detail': 'A request with this Idempotency-Key is still being processed'}, status_code=409
+                )
+            await response(scope, receive, send)
+            return
+
+        await self._run_original(scope, receive, send, body, user, key, record.claim_token)
+
+    async def _wait_for_original(self, user: str, key: str, timeout: float):
+        # Same-process duplicates wait on the original's event; otherwise poll the store
+        event = self._in_flight.get((user, key))
+        try:
+            if event is not None:
+                await asyncio.wait_for(event.wait(), timeout)
+            else:
+                await asyncio.sleep(min(POLL_INTERVAL_SECONDS, timeout))
+        except asyncio.TimeoutError:
+            pass
+
+    async def _renew_lease(self, user: str, key: str, token: str):
+        # Keeps a long-running original from looking abandoned to other workers
+        while True:
+            await asyncio.sleep(LEASE_RENEW_SECONDS)
+            try:
+                await run_in_threadpool(run_with_session, renew_claim, user, key, token)
+            except SQLAlchemyError:
+                pass  # Try again on the next tick; the lease outlasts several ticks
+
+    async def _run_original(self, scope, receive, send, body: bytes, user: str, key: str, token: str):
+        event = self._in_flight[(user, key)] = asyncio.Event()
+        body_sent = False
+        status_code = None
+        content_type = None
+        chunks = []
+
+        async def replay_receive():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+            return await receive()
+
+        async def capture_send(message):
+            nonlocal status_code, content_type
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+                for name, value in message.get('headers', []):
+                    if name.lower() == b'content-type':
+                        content_type = value.decode('latin-1')
+            elif message['type'] == 'http.response.body':
+                chunks.append(message.get('body', b''))
+            await send(message)
+
+        heartbeat = asyncio.create_task(self._renew_lease(user, key, token))
+        try:
+            try:
+                await self.app(scope, replay_receive, capture_send)
+            finally:
+                heartbeat.cancel()
+        except asyncio.CancelledError:
+            # Client disconnect or shutdown; another await here would be cancelled as
+            # well, so this one release runs synchronously
+            run_with_session(release_key, user, key, token)
+            raise
+        except Exception:
+            await self._settle_claim(release_key, user, key, token)
+            raise
+        else:
+            # Server errors are not stored so the client can retry them
+            if status_code is not None and status_code < 500:
+                await self._settle_claim(store_response, user, key, token, status_code, content_type,
+                                         b''.join(chunks))
+            else:
+                await self._settle_claim(release_key, user, key, token)
+        finally:
+            event.set()
+            self._in_flight.pop((user, key), None)
+
+    async def _settle_claim(self, func, *args):
+        # Runs off the event loop so a busy writer lock does not stall other requests, and
+        # shielded so the write is not abandoned halfway. A native task cancellation can
+        # still get through, in which case the write is finished synchronously.
+        try:
+            with anyio.CancelScope(shield=True):
+                await run_in_threadpool(run_with_session, func, *args)
+        except asyncio.CancelledError:
+            run_with_session(func, *args)
+            raise
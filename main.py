@@ -1,7 +1,7 @@
 from datetime import datetime
 
 from fastapi import FastAPI, HTTPException, Depends, Response, Request
-from sqlalchemy import column, func
+from sqlalchemy import column, func, true
 from sqlalchemy.orm import Session
 from database import SessionLocal, engine
 import models
@@ -12,18 +12,37 @@ from models import Member, Review, Book, BorrowRecord
 from starlette import status
 from starlette.middleware.base import BaseHTTPMiddleware
 from middleware import log_requests
+from scheduler import OverdueScheduler, clear_reminders
+from idempotency import IdempotencyMiddleware
+from migrations import upgrade_schema
 # from middleware import router as log_requests_router
 
+upgrade_schema(engine)
 models.Base.metadata.create_all(bind=engine)
 
 app = FastAPI()
 
+# Replay stored responses for retried writes carrying an Idempotency-Key header
+app.add_middleware(IdempotencyMiddleware)
 # Middleware for logging all requests
 app.add_middleware(BaseHTTPMiddleware, dispatch=log_requests)
 
 app.include_router(auth.router)
 # app.include_router(log_requests_router)
 
+# Background job that assigns due dates and flags overdue loans
+overdue_scheduler = OverdueScheduler()
+
+
+@app.on_event("startup")
+def start_overdue_scheduler():
+    overdue_scheduler.start()
+
+
+@app.on_event("shutdown")
+def stop_overdue_scheduler():
+    overdue_scheduler.stop()
+
 
 # Dependency to get the database session
 def get_db():
@@ -172,6 +191,7 @@ def borrow_book(user: user_dependency, book_id: int, member_id: int, db: Session
         book_id=book_id,
         member_id=member_id
     )
+    borrow_record.set_due_date()
 
     db.add(borrow_record)
     db.commit()
@@ -195,7 +215,8 @@ def return_book(user: user_dependency, book_id: int, member_id: int, db: Session
     # Set the return date to the current timestamp
     borrow_record.return_date = datetime.utcnow()
 
-    # Delete the BorrowRecord from the database
+    # Delete the BorrowRecord and any reminders queued for it from the database
+    clear_reminders(db, borrow_record.id)
     db.delete(borrow_record)
 
     # Commit the changes to the database
@@ -223,6 +244,16 @@ def read_borrowing_members(user: user_dependency, book_id: int, db: Session = De
     return borrowing_members
 
 
+# Declared before /borrow-records/{record_id} so "overdue" is not parsed as an id
+@app.get("/borrow-records/overdue", response_model=List[schemas.BorrowRecord])
+def list_overdue_borrow_records(user: user_dependency, skip: int = 0, limit: int = 10, db: Session = Depends(get_db)):
+    overdue_records = db.query(models.BorrowRecord).filter(
+        models.BorrowRecord.is_overdue == true(),
+        models.BorrowRecord.return_date.is_(None)
+    ).order_by(models.BorrowRecord.due_date, models.BorrowRecord.id).offset(skip).limit(limit).all()
+    return overdue_records
+
+
 @app.get("/borrow-records/{record_id}", response_model=schemas.BorrowRecord)
 def read_borrow_record(user: user_dependency, record_id: int, db: Session = Depends(get_db)):
     borrow_record = db.query(models.BorrowRecord).filter(models.BorrowRecord.id == record_id).first()
@@ -248,6 +279,9 @@ def update_borrow_record(user: user_dependency, record_id: int, return_date: sch
         raise HTTPException(status_code=400, detail="Book has already been returned")
 
     borrow_record.return_date = return_date.return_date
+    if borrow_record.return_date is not None:
+        borrow_record.is_overdue = False
+        clear_reminders(db, borrow_record.id, pending_only=True)
     db.commit()
     db.refresh(borrow_record)
     return borrow_record
@@ -258,6 +292,7 @@ def delete_borrow_record(user: user_dependency, record_id: int, db: Session = De
     borrow_record = db.query(models.BorrowRecord).filter(models.BorrowRecord.id == record_id).first()
     if borrow_record is None:
         raise HTTPException(status_code=404, detail="Borrow Record not found")
+    clear_reminders(db, borrow_record.id)
     db.delete(borrow_record)
     db.commit()
     return borrow_record
@@ -0,0 +1,55 @@
+from sqlalchemy import text
+from models import BorrowRecord
+
+
+def table_columns(conn, table: str):
+    # PRAGMA table_info rows are (cid, name, type, notnull, dflt_value, pk)
+    return {row[1]: row for row in conn.execute(text(f'PRAGMA table_info("{table}")'))}
+
+
+def index_names(conn):
+    return {row[0] for row in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'"))}
+
+
+def rebuild_borrow_records(conn):
+    # SQLite cannot drop NOT NULL in place, so copy the rows into a freshly created table.
+    # legacy_alter_table keeps other tables' foreign keys pointing at borrow_records.
+    conn.execute(text("PRAGMA legacy_alter_table = ON"))
+    conn.execute(text("ALTER TABLE borrow_records RENAME TO borrow_records_old"))
+    old_indexes = conn.execute(text(
+        "SELECT name FROM sqlite_master "
+        "WHERE type = 'index' AND tbl_name = 'borrow_records_old' AND sql IS NOT NULL"
+    )).all()
+    for (name,) in old_indexes:
+        conn.execute(text(f'DROP INDEX "{name}"'))
+
+    BorrowRecord.__table__.create(conn)
+    names = ', '.join(column.name for column in BorrowRecord.__table__.columns)
+    conn.execute(text(f"INSERT INTO borrow_records ({names}) SELECT {names} FROM borrow_records_old"))
+    conn.execute(text("DROP TABLE borrow_records_old"))
+    conn.execute(text("PRAGMA legacy_alter_table = OFF"))
+
+
+def upgrade_borrow_records(conn):
+    columns = table_columns(conn, 'borrow_records')
+    if not columns:
+        return
+
+    if 'due_date' not in columns:
+        conn.execute(text("ALTER TABLE borrow_records ADD COLUMN due_date DATETIME"))
+    if 'is_overdue' not in columns:
+        conn.execute(text("ALTER TABLE borrow_records ADD COLUMN is_overdue BOOLEAN NOT NULL DEFAULT 0"))
+    if columns['return_date'][3]:
+        rebuild_borrow_records(conn)
+
+    existing = index_names(conn)
+    for index in BorrowRecord.__table__.indexes:
+        if index.name not in existing:
+            index.create(conn)
+
+
+def upgrade_schema(bind):
+    # create_all never alters existing tables, so bring databases created before due
+    # dates were tracked up to the current layout. Must run before create_all.
+    with bind.begin() as conn:
+        upgrade_borrow_records(conn)
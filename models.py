@@ -1,9 +1,13 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Float
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Float, Boolean, Index, LargeBinary, \
+    UniqueConstraint
 from sqlalchemy.orm import relationship
 from datetime import datetime, timedelta
 from database import Base
 from sqlalchemy.orm import Session
 
+# How long a member may keep a borrowed book
+LOAN_PERIOD = timedelta(days=2)
+
 class Book(Base):
     __tablename__ = 'books'
     id = Column(Integer, primary_key=True, index=True)
@@ -24,21 +28,38 @@ class BorrowRecord(Base):
     __tablename__ = 'borrow_records'
     id = Column(Integer, primary_key=True, index=True)
     borrow_date = Column(DateTime, default=datetime.utcnow)
-    return_date = Column(DateTime, nullable=False)
+    return_date = Column(DateTime, nullable=True)
+    due_date = Column(DateTime)
+    is_overdue = Column(Boolean, default=False, nullable=False)
     book_id = Column(Integer, ForeignKey('books.id'))
     member_id = Column(Integer, ForeignKey('members.id'))
 
     book = relationship('Book', back_populates='borrow_records')
     member = relationship('Member', back_populates='borrow_records')
 
-    def set_return_date(self):
-        if self.borrow_date and not self.return_date:
-            self.return_date = self.borrow_date + timedelta(days=2)
+    # Serves the scheduler's "open, not yet overdue, due before now" range scan and
+    # the /borrow-records/overdue listing; returned loans sit outside both ranges.
+    __table_args__ = (
+        Index('ix_borrow_records_overdue_return_due_date', 'is_overdue', 'return_date', 'due_date'),
+    )
+
+    def set_due_date(self):
+        if self.borrow_date and not self.due_date:
+            self.due_date = self.borrow_date + LOAN_PERIOD
 
 
 Book.borrow_records = relationship('BorrowRecord', order_by=BorrowRecord.id, back_populates='book')
 Member.borrow_records = relationship('BorrowRecord', order_by=BorrowRecord.id, back_populates='member')
 
+class ReminderQueue(Base):
+    __tablename__ = 'reminder_queue'
+    id = Column(Integer, primary_key=True, index=True)
+    borrow_record_id = Column(Integer, ForeignKey('borrow_records.id'), unique=True)
+    member_id = Column(Integer, ForeignKey('members.id'))
+    created_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime, index=True)
+
+
 class Review(Base):
     __tablename__ = 'reviews'
     id = Column(Integer, primary_key=True, index=True)
@@ -70,4 +91,24 @@ class LogRecord(Base):
     url = Column(String)
     status_code = Column(Integer)
     timestamp = Column(DateTime, default=datetime.utcnow)
-    duration = Column(Float)
\ No newline at end of file
+    duration = Column(Float)
+
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+
+    id = Column(Integer, primary_key=True, index=True)
+    key = Column(String, nullable=False)
+    user = Column(String, nullable=False)
+    fingerprint = Column(String(64), nullable=False)  # sha256 of method, path and body
+    status_code = Column(Integer)  # NULL while the original request is still in flight
+    content_type = Column(String)
+    response_body = Column(LargeBinary)
+    claim_token = Column(String(32), nullable=False)  # identifies the current owner of an in-flight claim
+    locked_until = Column(DateTime, nullable=False)  # in-flight claims can be taken over after this
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+    __table_args__ = (
+        UniqueConstraint('user', 'key', name='uq_idempotency_keys_user_key'),
+    )
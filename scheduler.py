@@ -0,0 +1,163 @@
+import logging
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import DateTime, and_, exists, false, insert, literal, or_, select, true
+from sqlalchemy.orm import Session
+from database import SessionLocal
+from models import BorrowRecord, ReminderQueue, LOAN_PERIOD
+from idempotency import purge_expired_keys
+
+logger = logging.getLogger(__name__)
+
+# Rows written per transaction; keeps each hold on the SQLite writer lock short
+BATCH_SIZE = 200
+# Pause between batches so request handlers can grab the writer lock
+BATCH_PAUSE_SECONDS = 0.05
+# How often the scheduler wakes up to look for overdue loans
+INTERVAL_SECONDS = 60
+
+
+def assign_due_dates(db: Session, batch_size: int = BATCH_SIZE, pause: float = BATCH_PAUSE_SECONDS):
+    # Backfill due dates for open loans created before due dates were tracked
+    updated = 0
+    while True:
+        records = db.query(BorrowRecord.id, BorrowRecord.borrow_date).filter(
+            BorrowRecord.is_overdue == false(),
+            BorrowRecord.return_date.is_(None),
+            BorrowRecord.due_date.is_(None),
+            BorrowRecord.borrow_date.isnot(None)
+        ).limit(batch_size).all()
+
+        if not records:
+            break
+
+        db.bulk_update_mappings(BorrowRecord, [
+            {'id': record.id, 'due_date': record.borrow_date + LOAN_PERIOD} for record in records
+        ])
+        db.commit()
+        updated += len(records)
+
+        if len(records) < batch_size:
+            break
+        time.sleep(pause)
+
+    return updated
+
+
+def mark_overdue_loans(db: Session, now: datetime = None, batch_size: int = BATCH_SIZE,
+                       pause: float = BATCH_PAUSE_SECONDS):
+    # Walk the (is_overdue, return_date, due_date) index in keyset order, flagging open
+    # loans past their due date and queueing a reminder for each in the same transaction
+    now = now or datetime.utcnow()
+    last_due_date, last_id = None, None
+    marked = 0
+    while True:
+        query = db.query(BorrowRecord.id, BorrowRecord.member_id, BorrowRecord.due_date).filter(
+            BorrowRecord.is_overdue == false(),
+            BorrowRecord.return_date.is_(None),
+            BorrowRecord.due_date < now
+        )
+        if last_due_date is not None:
+            query = query.filter(or_(
+                BorrowRecord.due_date > last_due_date,
+                and_(BorrowRecord.due_date == last_due_date, BorrowRecord.id > last_id)
+            ))
+        candidates = query.order_by(BorrowRecord.due_date, BorrowRecord.id).limit(batch_size).all()
+
+        if not candidates:
+            break
+        last_due_date, last_id = candidates[-1].due_date, candidates[-1].id
+
+        # End the read transaction so the write below starts from a fresh snapshot;
+        # in WAL mode upgrading a stale read transaction fails instead of waiting
+        db.commit()
+
+        # Another worker may have flagged some candidates since they were read, so the
+        # UPDATE re-checks its filter and reminders are only queued for rows that were
+        # flagged without one. SQLite holds the writer lock from the UPDATE to the commit.
+        ids = [candidate.id for candidate in candidates]
+        flipped = db.query(BorrowRecord).filter(
+            BorrowRecord.id.in_(ids),
+            BorrowRecord.is_overdue == false(),
+            BorrowRecord.return_date.is_(None)
+        ).update({BorrowRecord.is_overdue: True}, synchronize_session=False)
+        db.execute(insert(ReminderQueue).from_select(
+            ['borrow_record_id', 'member_id', 'created_at'],
+            select(BorrowRecord.id, BorrowRecord.member_id, literal(now, DateTime)).where(
+                BorrowRecord.id.in_(ids),
+                BorrowRecord.is_overdue == true(),
+                ~exists().where(ReminderQueue.borrow_record_id == BorrowRecord.id)
+            )
+        ))
+        db.commit()
+        marked += flipped
+
+        if len(candidates) < batch_size:
+            break
+        time.sleep(pause)
+
+    return marked
+
+
+def clear_reminders(db: Session, borrow_record_id: int, pending_only: bool = False):
+    # Called when a loan is returned or deleted so no reminder goes out for it and a
+    # reused borrow_records id does not inherit the old loan's reminder; caller commits
+    query = db.query(ReminderQueue).filter(ReminderQueue.borrow_record_id == borrow_record_id)
+    if pending_only:
+        query = query.filter(ReminderQueue.sent_at.is_(None))
+    query.delete(synchronize_session=False)
+
+
+def run_overdue_check(batch_size: int = BATCH_SIZE):
+    db = SessionLocal()
+    try:
+        assigned = assign_due_dates(db, batch_size=batch_size)
+        marked = mark_overdue_loans(db, batch_size=batch_size)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+    if assigned or marked:
+        logger.info({'due_dates_assigned': assigned, 'loans_marked_overdue': marked})
+    return assigned, marked
+
+
+class OverdueScheduler:
+    def __init__(self, interval: float = INTERVAL_SECONDS, batch_size: int = BATCH_SIZE):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='overdue-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                run_overdue_check(self.batch_size)
+            except Exception:
+                logger.exception("Overdue check failed")
+            # Expired idempotency keys are cleared on the same schedule
+            db = SessionLocal()
+            try:
+                purge_expired_keys(db)
+            except Exception:
+                logger.exception("Idempotency key purge failed")
+            finally:
+                db.close()
+            self._stop_event.wait(self.interval)
@@ -43,6 +43,8 @@ class BorrowRecordCreate(BorrowRecordBase):
 
 class BorrowRecord(BorrowRecordBase):
     id: int
+    due_date: Optional[datetime] = None
+    is_overdue: bool = False
     book: Book
     member: Member
 
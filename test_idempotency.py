@@ -0,0 +1,238 @@
+import asyncio
+import threading
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+import idempotency
+from auth import create_access_token
+from database import Base, set_sqlite_pragma
+from idempotency import IdempotencyMiddleware, fingerprint_request, release_key, store_response
+from models import IdempotencyKey
+
+TOKEN = create_access_token('tester', 1, timedelta(minutes=20))
+HEADERS = {'Authorization': f'Bearer {TOKEN}', 'Idempotency-Key': 'key-1'}
+
+
+@pytest.fixture
+def session_factory(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    event.listen(engine, "connect", set_sqlite_pragma)
+    Base.metadata.create_all(bind=engine)
+    factory = sessionmaker(bind=engine, autocommit=False, autoflush=False, expire_on_commit=False)
+    monkeypatch.setattr(idempotency, 'SessionLocal', factory)
+    yield factory
+    engine.dispose()
+
+
+class Endpoint:
+    def __init__(self):
+        self.calls = 0
+        self.delay = 0
+        self.status_codes = []
+        self.block = None
+
+    def build_app(self):
+        app = FastAPI()
+        app.add_middleware(IdempotencyMiddleware)
+
+        @app.post('/books/')
+        async def create_book(request: Request):
+            self.calls += 1
+            if self.block is not None:
+                await self.block.wait()
+            await asyncio.sleep(self.delay)
+            status_code = self.status_codes.pop(0) if self.status_codes else 200
+            return JSONResponse({'call': self.calls, 'body': await request.json()}, status_code=status_code)
+
+        return app
+
+
+def post(app, *requests):
+    return post_to([app] * len(requests), *requests)
+
+
+def post_to(apps, *requests):
+    # Each request goes to its own app, so separate apps act like separate workers
+    async def send_all():
+        clients = [httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://test')
+                   for app in apps]
+        try:
+            return await asyncio.gather(*(client.post('/books/', **kwargs)
+                                          for client, kwargs in zip(clients, requests)))
+        finally:
+            for client in clients:
+                await client.aclose()
+
+    return asyncio.run(send_all())
+
+
+def count_keys(session_factory):
+    db = session_factory()
+    try:
+        return db.query(IdempotencyKey).count()
+    finally:
+        db.close()
+
+
+def test_retry_replays_stored_response(session_factory):
+    endpoint = Endpoint()
+    app = endpoint.build_app()
+
+    first, = post(app, {'json': {'title': 'a'}, 'headers': HEADERS})
+    second, = post(app, {'json': {'title': 'a'}, 'headers': HEADERS})
+
+    assert endpoint.calls == 1
+    assert second.status_code == first.status_code == 200
+    assert second.json() == first.json()
+    assert second.headers['Idempotent-Replayed'] == 'true'
+
+
+def test_reused_key_with_different_body_is_rejected(session_factory):
+    endpoint = Endpoint()
+    app = endpoint.build_app()
+
+    post(app, {'json': {'title': 'a'}, 'headers': HEADERS})
+    response, = post(app, {'json': {'title': 'b'}, 'headers': HEADERS})
+
+    assert response.status_code == 422
+    assert endpoint.calls == 1
+
+
+def test_unauthenticated_requests_bypass_the_store(session_factory):
+    endpoint = Endpoint()
+    app = endpoint.build_app()
+    headers = {'Idempotency-Key': 'key-1'}
+
+    post(app, {'json': {'title': 'a'}, 'headers': headers})
+    post(app, {'json': {'title': 'a'}, 'headers': headers})
+
+    assert endpoint.calls == 2
+    assert count_keys(session_factory) == 0
+
+
+def test_concurrent_duplicate_waits_for_original(session_factory):
+    endpoint = Endpoint()
+    endpoint.delay = 0.2
+    app = endpoint.build_app()
+
+    first, second = post(app, {'json': {'title': 'a'}, 'headers': HEADERS},
+                         {'json': {'title': 'a'}, 'headers': HEADERS})
+
+    assert endpoint.calls == 1
+    assert first.json() == second.json()
+
+
+def test_server_error_releases_key(session_factory):
+    endpoint = Endpoint()
+    endpoint.status_codes = [500]
+    app = endpoint.build_app()
+
+    first, = post(app, {'json': {'title': 'a'}, 'headers': HEADERS})
+    second, = post(app, {'json': {'title': 'a'}, 'headers': HEADERS})
+
+    assert (first.status_code, second.status_code) == (500, 200)
+    assert endpoint.calls == 2
+
+
+def test_server_error_release_runs_off_the_event_loop(session_factory, monkeypatch):
+    endpoint = Endpoint()
+    endpoint.status_codes = [500]
+    app = endpoint.build_app()
+    release_threads = []
+    run_with_session = idempotency.run_with_session
+
+    def record_thread(func, *args):
+        if func is release_key:
+            release_threads.append(threading.current_thread())
+        return run_with_session(func, *args)
+
+    monkeypatch.setattr(idempotency, 'run_with_session', record_thread)
+    post(app, {'json': {'title': 'a'}, 'headers': HEADERS})
+
+    assert release_threads and threading.main_thread() not in release_threads
+    assert count_keys(session_factory) == 0
+
+
+def test_cancelled_request_releases_key(session_factory):
+    endpoint = Endpoint()
+    app = endpoint.build_app()
+
+    async def cancel_mid_flight():
+        endpoint.block = asyncio.Event()
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            task = asyncio.create_task(client.post('/books/', json={'title': 'a'}, headers=HEADERS))
+            while endpoint.calls == 0:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+    asyncio.run(cancel_mid_flight())
+    assert count_keys(session_factory) == 0
+
+    endpoint.block = None
+    response, = post(app, {'json': {'title': 'a'}, 'headers': HEADERS})
+    assert response.status_code == 200
+    assert endpoint.calls == 2
+
+
+def test_expired_lease_is_taken_over(session_factory):
+    endpoint = Endpoint()
+    app = endpoint.build_app()
+    now = datetime.utcnow()
+
+    # Simulates a worker that died after claiming the key
+    db = session_factory()
+    db.add(IdempotencyKey(key='key-1', user='tester', claim_token='abandoned', created_at=now,
+                          fingerprint=fingerprint_request('POST', '/books/', b'{"title":"a"}'),
+                          locked_until=now - timedelta(seconds=1), expires_at=now + timedelta(hours=1)))
+    db.commit()
+    db.close()
+
+    response, = post(app, {'content': b'{"title":"a"}', 'headers': {**HEADERS, 'Content-Type': 'application/json'}})
+
+    assert response.status_code == 200
+    assert endpoint.calls == 1
+
+
+@pytest.fixture
+def short_lease(monkeypatch):
+    monkeypatch.setattr(idempotency, 'WAIT_TIMEOUT_SECONDS', 0.5)
+    monkeypatch.setattr(idempotency, 'CLAIM_LEASE', timedelta(seconds=0.3))
+    monkeypatch.setattr(idempotency, 'LEASE_RENEW_SECONDS', 0.1)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_duplicate_of_long_running_original_gets_conflict(session_factory, short_lease, workers):
+    endpoint = Endpoint()
+    endpoint.delay = 1.5
+    app = endpoint.build_app()
+    apps = [app, endpoint.build_app() if workers == 2 else app]
+
+    responses = post_to(apps, {'json': {'title': 'a'}, 'headers': HEADERS},
+                        {'json': {'title': 'a'}, 'headers': HEADERS})
+
+    assert endpoint.calls == 1
+    assert sorted(response.status_code for response in responses) == [200, 409]
+
+
+def test_stale_owner_cannot_touch_new_claim(session_factory):
+    now = datetime.utcnow()
+    db = session_factory()
+    db.add(IdempotencyKey(key='key-1', user='tester', claim_token='new-owner', fingerprint='fp', created_at=now,
+                          locked_until=now + timedelta(seconds=10), expires_at=now + timedelta(hours=1)))
+    db.commit()
+
+    store_response(db, 'tester', 'key-1', 'old-owner', 200, 'application/json', b'{}')
+    release_key(db, 'tester', 'key-1', 'old-owner')
+
+    record = db.query(IdempotencyKey).one()
+    assert record.status_code is None
+    db.close()
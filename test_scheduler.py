@@ -0,0 +1,170 @@
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+import auth
+import database
+import middleware
+import scheduler
+from database import Base, set_sqlite_pragma
+from models import Book, BorrowRecord, Member, ReminderQueue, LOAN_PERIOD
+
+NOW = datetime(2026, 1, 10)
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    event.listen(engine, "connect", set_sqlite_pragma)
+    Base.metadata.create_all(bind=engine)
+    yield sessionmaker(bind=engine, autocommit=False, autoflush=False, expire_on_commit=False)
+    engine.dispose()
+
+
+@pytest.fixture
+def client(session_factory, monkeypatch):
+    # main creates its tables on import; point it at the test engine instead of test.db
+    monkeypatch.setattr(database, 'engine', session_factory.kw['bind'])
+    import main
+
+    def get_test_db():
+        db = session_factory()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    monkeypatch.setattr(middleware, 'SessionLocal', session_factory)
+    main.app.dependency_overrides[main.get_db] = get_test_db
+    main.app.dependency_overrides[auth.get_current_user] = lambda: {'username': 'tester', 'id': 1}
+    yield TestClient(main.app)
+    main.app.dependency_overrides.clear()
+
+
+def add_loans(db, count, borrow_date, returned=False, with_due_date=True):
+    for i in range(count):
+        record = BorrowRecord(borrow_date=borrow_date, book_id=i, member_id=i,
+                              return_date=NOW if returned else None)
+        if with_due_date:
+            record.set_due_date()
+        db.add(record)
+    db.commit()
+
+
+def test_assign_due_dates_backfills_open_loans_in_batches(session_factory):
+    db = session_factory()
+    add_loans(db, 25, NOW - timedelta(days=1), with_due_date=False)
+    add_loans(db, 5, NOW - timedelta(days=1), returned=True, with_due_date=False)
+
+    assert scheduler.assign_due_dates(db, batch_size=10, pause=0) == 25
+    open_records = db.query(BorrowRecord).filter(BorrowRecord.return_date.is_(None)).all()
+    assert all(record.due_date == record.borrow_date + LOAN_PERIOD for record in open_records)
+    db.close()
+
+
+def test_mark_overdue_loans_flags_only_open_past_due_loans(session_factory):
+    db = session_factory()
+    add_loans(db, 23, NOW - timedelta(days=5))
+    add_loans(db, 4, NOW - timedelta(days=5), returned=True)
+    add_loans(db, 3, NOW)
+
+    assert scheduler.mark_overdue_loans(db, now=NOW, batch_size=10, pause=0) == 23
+    assert db.query(BorrowRecord).filter(BorrowRecord.is_overdue.is_(True)).count() == 23
+    assert db.query(ReminderQueue).count() == 23
+
+    assert scheduler.mark_overdue_loans(db, now=NOW, batch_size=10, pause=0) == 0
+    assert db.query(ReminderQueue).count() == 23
+    db.close()
+
+
+def test_mark_overdue_loans_skips_returned_loans_without_scanning(session_factory):
+    db = session_factory()
+    add_loans(db, 1000, NOW - timedelta(days=5), returned=True)
+
+    statements = []
+    event.listen(db.get_bind(), "before_cursor_execute",
+                 lambda conn, cursor, statement, *args: statements.append(statement))
+    assert scheduler.mark_overdue_loans(db, now=NOW, batch_size=100, pause=0) == 0
+    assert len(statements) == 1
+    db.close()
+
+
+def test_concurrent_runs_queue_one_reminder_per_loan(session_factory):
+    db = session_factory()
+    add_loans(db, 60, NOW - timedelta(days=5))
+    db.close()
+
+    results, errors = [], []
+
+    def run():
+        session = session_factory()
+        try:
+            results.append(scheduler.mark_overdue_loans(session, now=NOW, batch_size=5, pause=0))
+        except Exception as exc:
+            errors.append(exc)
+        finally:
+            session.close()
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    db = session_factory()
+    assert errors == []
+    assert sum(results) == 60
+    assert db.query(ReminderQueue).count() == 60
+    db.close()
+
+
+def flag_one_overdue_loan(session_factory):
+    db = session_factory()
+    book = Book(title='t', author='a', isbn='1', type_of_book='x')
+    member = Member(name='n', email='e', membership_id='m')
+    db.add_all([book, member])
+    db.commit()
+    record = BorrowRecord(borrow_date=NOW - timedelta(days=5), book_id=book.id, member_id=member.id)
+    record.set_due_date()
+    db.add(record)
+    db.commit()
+    scheduler.mark_overdue_loans(db, now=NOW, pause=0)
+    db.close()
+    return record.id
+
+
+def test_returning_a_loan_clears_its_reminder(session_factory, client):
+    flag_one_overdue_loan(session_factory)
+
+    assert client.post('/return/1/1').status_code == 200
+    db = session_factory()
+    assert db.query(ReminderQueue).count() == 0
+    db.close()
+
+
+def test_updating_return_date_clears_pending_reminder(session_factory, client):
+    record_id = flag_one_overdue_loan(session_factory)
+
+    response = client.put(f'/borrow-records/{record_id}', json={'borrow_date': None, 'return_date': NOW.isoformat()})
+    assert response.status_code == 200
+    assert response.json()['is_overdue'] is False
+    db = session_factory()
+    assert db.query(ReminderQueue).count() == 0
+    db.close()
+
+
+def test_deleted_loan_id_reuse_gets_its_own_reminder(session_factory, client):
+    record_id = flag_one_overdue_loan(session_factory)
+    assert client.delete(f'/borrow-records/{record_id}').status_code == 200
+
+    db = session_factory()
+    assert db.query(ReminderQueue).count() == 0
+    add_loans(db, 1, NOW - timedelta(days=5))
+    assert db.query(BorrowRecord.id).scalar() == record_id
+    assert scheduler.mark_overdue_loans(db, now=NOW, pause=0) == 1
+    assert db.query(ReminderQueue).filter(ReminderQueue.borrow_record_id == record_id).count() == 1
+    db.close()